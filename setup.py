@@ -12,7 +12,7 @@ setup(
     author="Thomas FEL",
     author_email="thomas_fel@brown.edu",
     license="MIT",
-    install_requires=['tensorflow>=2.1.0', 'numpy', 'scikit-learn', 'scikit-image',
+    install_requires=['tensorflow>=2.5.0', 'numpy', 'scikit-learn', 'scikit-image',
                       'matplotlib', 'scipy', 'opencv-python'],
     extras_require={
         "tests": ["pytest", "pylint"],
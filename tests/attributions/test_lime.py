@@ -1,21 +1,34 @@
 """
 Tests for Lime Module
 """
+import warnings
+
 import numpy as np
 import tensorflow as tf
 from sklearn import linear_model
 from xplique.attributions import Lime
+from xplique.commons import euclidean_similarities, cosine_similarities, predictions_one_hot
 from ..utils import generate_data, generate_model, almost_equal
 
 
-def test_pertub_func():
-    """Ensure the default pertub function has the right output"""
-    num_features = 10
-    pertub_func = Lime._get_default_pertub_function(prob = 0.5)
-    samples = pertub_func(num_features, 12)
+def test_custom_pertub_func():
+    """Ensure a custom pertub function gets the number of features of an input as a (1,) tensor"""
+    nb_labels = 10
 
-    assert samples.shape == (12,10)
-    assert samples.dtype == tf.int32
+    samples, labels = generate_data((8, 8, 3), nb_labels, 4)
+    model = generate_model((8, 8, 3), nb_labels)
+
+    def custom_pertub_func(num_features, nb_samples):
+        assert num_features.shape == (1,)
+        return tf.cast(tf.random.uniform((nb_samples, num_features[0])) > 0.5, tf.int32)
+
+    method = Lime(model,
+                  pertub_func=custom_pertub_func,
+                  map_to_interpret_space=lambda inp: tf.reshape(tf.range(64) // 4, (8, 8)),
+                  nb_samples=10)
+
+    explanations = method.explain(samples, labels)
+    assert samples.shape[:3] == explanations.shape
 
 
 def test_get_masks():
@@ -35,15 +48,15 @@ def test_get_masks():
     # last one just miss the upper right
     interpret_sample4 = [1,0,1,1]
 
-    interpret_samples = tf.constant([interpret_sample1,
-                                     interpret_sample2,
-                                     interpret_sample3,
-                                     interpret_sample4])
+    interpret_samples = tf.cast(tf.constant([interpret_sample1,
+                                             interpret_sample2,
+                                             interpret_sample3,
+                                             interpret_sample4]), tf.bool)
 
-    masks = Lime._get_masks(interpret_samples,mapping_to_interpret_space)
-    assert masks.shape == (4,4,4)
-    assert masks.dtype == tf.int32
-    masks.numpy()
+    masks = Lime._get_masks(interpret_samples[None], mapping_to_interpret_space[None])
+    assert masks.shape == (1,4,4,4)
+    assert masks.dtype == tf.bool
+    masks = masks[0].numpy()
     expected_mask1 = np.array([[0,0,1,1],[0,0,1,1],[0,0,0,0],[0,0,0,0]])
     assert np.array_equal(masks[0],expected_mask1)
 
@@ -72,17 +85,46 @@ def test_apply_masks():
     baseline = tf.constant([125.0,255.0,0.0])
 
     masks = tf.constant([mask1,mask2])
-    samples = Lime._apply_masks(img,masks,baseline)
-    assert samples.shape == (2,2,2,3)
+    samples = Lime._apply_masks(img[None],masks[None],baseline)
+    assert samples.shape == (1,2,2,2,3)
     assert samples.dtype == tf.float32
 
-    samples.numpy()
+    samples = samples[0].numpy()
     expected_sample1 = np.array([[[125,255,0],[1,1,1]],[[125,255,0],[125,255,0]]])
     assert np.array_equal(samples[0],expected_sample1)
 
     expected_sample2 = np.array([[[1,1,1],[125,255,0]],[[1,1,1],[1,1,1]]])
     assert np.array_equal(samples[1],expected_sample2)
 
+def test_broadcast_explanation():
+    """
+    Ensure the broadcast_explanation function gives to each feature the coefficient of its
+    interpretable feature, for several inputs at once
+    """
+    mappings = tf.constant([[[0,0],[1,1]], [[0,1],[2,2]]])
+    explanations = tf.constant([[1.0, 2.0, 0.0], [3.0, 4.0, 5.0]])
+
+    broadcast_explanations = Lime._broadcast_explanation(explanations, mappings)
+    assert broadcast_explanations.shape == (2,2,2)
+    assert broadcast_explanations.dtype == tf.float32
+
+    expected_explanations = np.array([[[1,1],[2,2]], [[3,4],[5,5]]])
+    assert np.array_equal(broadcast_explanations.numpy(), expected_explanations)
+
+def test_similarities_tracing():
+    """
+    Ensure the default kernels are traced once whatever the number of samples, and do not
+    depend on the number of interpretable features
+    """
+    for kernel, compiled_kernel in [(Lime._euclidean_similarity_kernel, euclidean_similarities),
+                                    (Lime._cosine_similarity_kernel, cosine_similarities)]:
+        for nb_samples in [5, 7]:
+            for num_features in [6, 9]:
+                kernel(tf.ones((4, 4, 3)), tf.ones((nb_samples, num_features), tf.int32),
+                       tf.ones((nb_samples, 4, 4, 3)), tf.constant(1.0))
+        assert compiled_kernel.experimental_get_tracing_count() == 1
+
+
 def test_similarities():
     """
     Ensure that the compute similarity function behave as expected (shape, type)
@@ -101,8 +143,8 @@ def test_similarities():
         [int_sample1, int_sample2, int_sample3, int_sample4],
         dtype=tf.int32
     )
-    masks = Lime._get_masks(int_samples, mapping)
-    pertubed_samples = Lime._apply_masks(original_input, masks, ref_value)
+    masks = Lime._get_masks(tf.cast(int_samples[None], tf.bool), mapping[None])
+    pertubed_samples = Lime._apply_masks(original_input[None], masks, ref_value)[0]
 
     similarity_kernel = Lime._get_exp_kernel_func()
     similarities = similarity_kernel(original_input, int_samples, pertubed_samples)
@@ -121,6 +163,177 @@ def test_similarities():
     assert similarities2.shape == 4
     assert similarities2.dtype == tf.float32
 
+    cosines = np.sqrt(np.array([2.0, 2.0, 1.0, 3.0]) / 4.0)
+    expected_outcome2 = np.exp(-(1.0 - cosines)**2)
+
+    similarities2 = similarities2.numpy()
+    assert almost_equal(similarities2,expected_outcome2)
+
+
+def test_batched_similarity_kernel():
+    """
+    Ensure the default kernels compute the similarities of several inputs at once as they do
+    input by input, and that custom kernels are still called for each input
+    """
+    original_inputs = tf.random.uniform((3, 4, 4, 3))
+    perturbed_samples = tf.random.uniform((3, 6, 4, 4, 3))
+    interpret_samples = [tf.ones((6, num_features), tf.int32) for num_features in [2, 5, 7]]
+
+    for distance_mode in ["euclidean", "cosine"]:
+        similarity_kernel = Lime._get_exp_kernel_func(distance_mode, 2.0)
+        batched_similarities = Lime._get_batched_similarity_kernel(similarity_kernel)(
+            original_inputs, interpret_samples, perturbed_samples)
+
+        assert batched_similarities.shape == (3, 6)
+        for inp, int_samples, pert_samples, similarities in zip(
+                original_inputs, interpret_samples, perturbed_samples, batched_similarities):
+            assert almost_equal(similarities.numpy(),
+                                similarity_kernel(inp, int_samples, pert_samples).numpy())
+
+    kernel_calls = []
+    def custom_kernel(inp, int_samples, pert_samples):
+        kernel_calls.append(int_samples.shape)
+        return tf.ones(len(pert_samples), tf.float64)
+
+    custom_similarities = Lime._get_batched_similarity_kernel(custom_kernel)(
+        original_inputs, interpret_samples, perturbed_samples)
+
+    assert kernel_calls == [(6, 2), (6, 5), (6, 7)]
+    assert custom_similarities.shape == (3, 6)
+    assert custom_similarities.dtype == tf.float32
+
+
+def test_wide_tabular_model():
+    """Ensure the default batch size handles tabular inputs with a wide model"""
+    inputs = np.random.rand(300, 10).astype(np.float32)
+    targets = np.eye(3)[np.random.randint(0, 3, 300)].astype(np.float32)
+    model = tf.keras.Sequential([
+        tf.keras.layers.Input((10,)),
+        tf.keras.layers.Dense(1024, activation="relu"),
+        tf.keras.layers.Dense(1024, activation="relu"),
+        tf.keras.layers.Dense(3),
+    ])
+
+    explanations = Lime(model).explain(inputs, targets)
+    assert explanations.shape == inputs.shape
+
+def test_functions_cache():
+    """Ensure the default kernels and pertub functions are shared between explainers"""
+    model = generate_model((8, 8, 3), 10)
+
+    method1 = Lime(model, kernel_width=10.0, prob=0.3)
+    method2 = Lime(model, kernel_width=10.0, prob=0.3)
+    assert method1.similarity_kernel is method2.similarity_kernel
+    assert method1.pertub_func is method2.pertub_func
+
+    method3 = Lime(model, distance_mode="cosine", kernel_width=10.0, prob=0.4)
+    assert method1.similarity_kernel is not method3.similarity_kernel
+    assert method1.pertub_func is not method3.pertub_func
+
+    # tensors are accepted as well
+    method4 = Lime(model, kernel_width=tf.constant(10.0), prob=tf.constant(0.5))
+    assert method1.similarity_kernel is method4.similarity_kernel
+    assert method4.pertub_func is Lime(model, prob=0.5).pertub_func
+
+def test_batch_predictions():
+    """
+    Ensure each perturbed sample is predicted for the target of its input and that the
+    predictions fall back to float32 when the model rejects predict_dtype
+    """
+    # 3 inputs with 4 perturbed samples each
+    samples = tf.random.uniform((12, 4, 4))
+    targets = tf.one_hot(tf.range(3), 3)
+    weights = tf.random.uniform((3,))
+
+    inference_function = lambda model, x, y: tf.reduce_sum(model(x) * y, axis=-1)
+    # this model only supports float32 inputs
+    model = lambda x: tf.reshape(x, (len(x), -1))[:, :3] * weights
+
+    expected = Lime._batch_predictions(inference_function, model, samples, targets, 4, 5)
+    # each perturbed sample gets the target of its input
+    inputs_indices = np.arange(12) // 4
+    flatten_samples = tf.reshape(samples, (12, -1)).numpy()
+    assert almost_equal(expected, flatten_samples[np.arange(12), inputs_indices] *
+                        weights.numpy()[inputs_indices], 1e-4)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        predictions = Lime._batch_predictions(inference_function, model, samples, targets, 4, 5,
+                                              tf.bfloat16)
+    assert len(caught) == 1
+    assert predictions.dtype == tf.float32
+    assert almost_equal(predictions, expected)
+
+    # a model which handles the bfloat16 inputs
+    cast_model = lambda x: model(tf.cast(x, tf.float32))
+    predictions = Lime._batch_predictions(inference_function, cast_model, samples, targets, 4, 5,
+                                          tf.bfloat16)
+    assert predictions.dtype == tf.float32
+    assert almost_equal(predictions, expected, 1e-1)
+
+    # a mixed precision model returning bfloat16 outputs gets targets of the same dtype
+    mixed_model = tf.keras.Sequential([
+        tf.keras.layers.Input((4, 4)),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(3, dtype="mixed_bfloat16"),
+    ])
+    mixed_expected = Lime._batch_predictions(predictions_one_hot, mixed_model, samples, targets,
+                                             4, 5)
+    assert mixed_expected.dtype == tf.float32
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        predictions = Lime._batch_predictions(predictions_one_hot, mixed_model, samples, targets,
+                                              4, 5, tf.bfloat16)
+    assert len(caught) == 0
+    assert predictions.dtype == tf.float32
+    assert almost_equal(predictions, mixed_expected, 1e-1)
+
+    # the other errors (e.g OOM) are not caught
+    def oom_model(x):
+        raise tf.errors.ResourceExhaustedError(None, None, "OOM")
+
+    try:
+        Lime._batch_predictions(inference_function, oom_model, samples, targets, 4, 5,
+                                tf.bfloat16)
+        raise AssertionError("The OOM error should be raised")
+    except tf.errors.ResourceExhaustedError:
+        pass
+
+
+def test_mappings_dataset():
+    """
+    Ensure the inputs are grouped in order along with their mappings
+    """
+    inputs = tf.reshape(tf.range(5 * 4 * 2, dtype=tf.float32), (5, 4, 2))
+    targets = tf.one_hot(tf.range(5), 5)
+
+    # a map function working on numpy arrays
+    map_func = lambda inp: np.argsort(inp.numpy()[:, 0]) % 2
+
+    groups = list(Lime._get_mappings_dataset(map_func, inputs, targets, 2))
+    assert [len(b_inp) for b_inp, _, _ in groups] == [2, 2, 1]
+
+    for b_inp, b_targets, mappings in groups:
+        assert mappings.dtype == tf.int32
+        assert mappings.shape == (len(b_inp), 4)
+
+    assert almost_equal(tf.concat([b_inp for b_inp, _, _ in groups], axis=0), inputs)
+    assert almost_equal(tf.concat([b_targets for _, b_targets, _ in groups], axis=0), targets)
+
+    # an input explained for several targets is only mapped once
+    mapped_inputs = []
+    def counting_map_func(inp):
+        mapped_inputs.append(inp)
+        return map_func(inp)
+
+    repeated_inputs = tf.repeat(inputs[:2], 3, axis=0)
+    repeated_targets = tf.one_hot(tf.range(6) % 3, 5)
+    groups = list(Lime._get_mappings_dataset(counting_map_func, repeated_inputs,
+                                             repeated_targets, 4))
+    assert len(mapped_inputs) == 2
+    assert almost_equal(groups[0][2][0], groups[0][2][2])
+
+
 def test_compute():
     """The output shape must be the same as the input shape, except for the channels"""
     input_shapes = [(28, 28, 1), (32, 32, 3)]
@@ -146,14 +359,57 @@ def test_compute():
         samples, labels = generate_data(input_shape, nb_labels, 20)
         model = generate_model(input_shape, nb_labels)
 
+        interpretable_model = linear_model.Lasso(alpha=0.1)
         method = Lime(model,
-                      interpretable_model=linear_model.Lasso(alpha=0.1),
+                      interpretable_model=interpretable_model,
                       map_to_interpret_space=map_four_by_four,
                       nb_samples=10,
                       kernel_width=10)
 
         explanations = method.explain(samples, labels)
         assert samples.shape[:3] == explanations.shape
+        # the interpretable model given is not shared between the inputs
+        assert not hasattr(interpretable_model, "coef_")
+
+def test_degenerate_similarities():
+    """Ensure null similarities are replaced by uniform weights and the kernel width adapted"""
+    nb_labels = 10
+
+    samples, labels = generate_data((8, 8, 3), nb_labels, 4)
+    model = generate_model((8, 8, 3), nb_labels)
+    map_pixels = lambda inp: tf.reshape(tf.range(64), (8, 8))
+
+    method = Lime(model,
+                  similarity_kernel=lambda inp, int_samples, pert_samples: tf.zeros(10),
+                  map_to_interpret_space=map_pixels,
+                  nb_samples=10)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        explanations = method.explain(samples, labels)
+    assert any("close to 0" in str(warning.message) for warning in caught)
+    assert np.all(np.isfinite(explanations))
+
+    # the kernel width is only adapted for the default euclidean kernel
+    assert Lime(model, auto_kernel_width=True).similarity_kernel is None
+    for kwargs in [{"distance_mode": "cosine"}, {"similarity_kernel": method.similarity_kernel}]:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            ignored_method = Lime(model, auto_kernel_width=True, **kwargs)
+        assert any("auto_kernel_width" in str(warning.message) for warning in caught)
+        assert ignored_method.similarity_kernel is not None
+
+    method = Lime(model,
+                  map_to_interpret_space=map_pixels,
+                  nb_samples=10,
+                  kernel_width=1e-3,
+                  auto_kernel_width=True)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        explanations = method.explain(samples, labels)
+    assert not any("close to 0" in str(warning.message) for warning in caught)
+    assert samples.shape[:3] == explanations.shape
 
 def test_inputs_batching():
     """ Ensure, that we can call explain with batched inputs """
@@ -170,3 +426,62 @@ def test_inputs_batching():
 
     explanations = method.explain(samples, labels)
     assert samples.shape[:3] == explanations.shape
+
+def test_samples_slicing():
+    """
+    Ensure that when nb_samples is larger than batch_size, at most batch_size perturbed
+    samples are built at once
+    """
+    nb_labels = 10
+
+    samples, labels = generate_data((8, 8, 3), nb_labels, 2)
+    model = generate_model((8, 8, 3), nb_labels)
+
+    kernel_calls = []
+    def recording_kernel(inp, int_samples, pert_samples):
+        kernel_calls.append((len(int_samples), len(pert_samples)))
+        return tf.ones(len(int_samples))
+
+    method = Lime(model,
+                  batch_size=16,
+                  similarity_kernel=recording_kernel,
+                  map_to_interpret_space=lambda inp: tf.reshape(tf.range(64), (8, 8)),
+                  nb_samples=40)
+
+    explanations = method.explain(samples, labels)
+    assert samples.shape[:3] == explanations.shape
+    assert kernel_calls == [(16, 16), (16, 16), (8, 8)] * 2
+
+
+def test_inputs_grouping():
+    """
+    Ensure that inputs with different interpretable spaces can be processed within
+    the same group of perturbed samples
+    """
+    nb_labels = 10
+
+    samples, labels = generate_data((8, 8, 3), nb_labels, 6)
+    model = generate_model((8, 8, 3), nb_labels)
+
+    def map_by_rows(inp):
+        # dark inputs are mapped row by row, the others pixel by pixel
+        mapping = tf.range(inp.shape[0] * inp.shape[1]) // inp.shape[1]
+        if tf.reduce_mean(inp) > 0.5:
+            mapping = tf.range(inp.shape[0] * inp.shape[1])
+        return tf.reshape(mapping, inp.shape[:2])
+
+    samples[::2] = 0.0
+    samples[1::2] = 1.0
+
+    method = Lime(model,
+                  batch_size=30,
+                  map_to_interpret_space=map_by_rows,
+                  nb_samples=10,
+                  kernel_width=10)
+
+    explanations = method.explain(samples, labels)
+    assert samples.shape[:3] == explanations.shape
+
+    # the features of the same row share the same coefficient
+    for explanation in explanations[::2]:
+        assert np.all(explanation == explanation[:, :1])
@@ -0,0 +1,85 @@
+import numpy as np
+import tensorflow as tf
+from sklearn import linear_model
+
+from xplique.commons import get_default_pertub_function, has_ridge_closed_form, solve_ridge, \
+    get_auto_batch_size
+
+from ..utils import almost_equal
+
+
+def test_pertub_func():
+    """Ensure the default pertub function has the right output"""
+    num_features = 10
+    pertub_func = get_default_pertub_function(prob = 0.5)
+    samples = pertub_func(num_features, 12)
+
+    assert samples.shape == (12,10)
+    assert samples.dtype == tf.bool
+
+    # samples of several inputs are drawn at once
+    samples = pertub_func(tf.constant([10, 4]), 12)
+
+    assert samples.shape == (2,12,10)
+    assert samples.dtype == tf.bool
+    assert not tf.reduce_any(samples[1, :, 4:])
+
+    # with latin hypercube sampling each feature is kept in the same proportion of samples
+    samples = get_default_pertub_function(0.25, "lhs")(num_features, 12)
+    assert np.all(tf.reduce_sum(tf.cast(samples, tf.int32), axis=0) == 3)
+
+    samples = get_default_pertub_function(0.5, "uniform")(num_features, 12)
+    assert samples.shape == (12,10)
+    assert samples.dtype == tf.bool
+
+
+def test_has_ridge_closed_form():
+    """Ensure only the ridge regressions with a scalar positive alpha use the closed form"""
+    assert has_ridge_closed_form(linear_model.Ridge(alpha=2.0))
+    assert not has_ridge_closed_form(linear_model.Ridge(alpha=0.0))
+    assert not has_ridge_closed_form(linear_model.Ridge(alpha=[1.0, 2.0]))
+    assert not has_ridge_closed_form(linear_model.Ridge(alpha=1.0, positive=True))
+    assert not has_ridge_closed_form(linear_model.Lasso(alpha=1.0))
+
+
+def test_solve_ridge():
+    """
+    Ensure the batched closed form of the ridge regression gives the same coefficients
+    as scikit-learn, with more or less interpretable features than samples
+    """
+    for nb_samples, num_features in [(20, 5), (4, 6)]:
+        interpret_samples = tf.cast(
+            tf.random.uniform((3, nb_samples, num_features)) > 0.5, tf.int32)
+        perturbed_targets = tf.random.uniform((3, nb_samples))
+        similarities = tf.random.uniform((3, nb_samples), minval=0.1, maxval=1.0)
+
+        coefs = solve_ridge(interpret_samples, perturbed_targets, similarities, 2.0)
+        assert coefs.shape == (3, num_features)
+        assert coefs.dtype == tf.float32
+
+        for inp_idx in range(3):
+            ridge = linear_model.Ridge(alpha=2.0)
+            ridge.fit(interpret_samples[inp_idx].numpy(),
+                      perturbed_targets[inp_idx].numpy(),
+                      sample_weight=similarities[inp_idx].numpy())
+            assert almost_equal(coefs[inp_idx].numpy(), ridge.coef_, epsilon=1e-4)
+
+    # the solver is not retraced for each regularization strength
+    tracing_count = solve_ridge.experimental_get_tracing_count()
+    for alpha in [1.0, 3.0]:
+        solve_ridge(interpret_samples, perturbed_targets, similarities, tf.constant(alpha))
+    assert solve_ridge.experimental_get_tracing_count() <= tracing_count + 1
+
+
+def test_auto_batch_size():
+    """Ensure the automatic batch size decreases with the inputs size"""
+    small_batch_size = get_auto_batch_size((32, 32, 3), 150)
+    large_batch_size = get_auto_batch_size((299, 299, 3), 150)
+
+    assert isinstance(large_batch_size, int)
+    assert 1 <= large_batch_size < small_batch_size
+    assert get_auto_batch_size((32, 32, 3), 150, memory_budget=1) == 1
+
+    # the batch size of small inputs is bounded
+    assert get_auto_batch_size((10,), 150) == 1024
+    assert get_auto_batch_size((10,), 2000) == 2000
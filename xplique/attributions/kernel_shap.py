@@ -26,7 +26,9 @@ class KernelShap(Lime):
     batch_size
         Number of perturbed samples to process at once, mandatory when nb_samples is huge.
         Notice, it is different compare to WhiteBox explainers which batch the inputs.
-        Here inputs are process one by one.
+        Here inputs are grouped so that the perturbed samples of several inputs are processed
+        at once when they fit in batch_size, otherwise the perturbed samples of an input are
+        built and processed batch_size at a time.
     map_to_interpret_space
         Function which group features of an input corresponding to the same interpretable
         feature (e.g super-pixel).
@@ -140,6 +142,6 @@ class KernelShap(Lime):
         equal probability. See the `_kernel_shap_pertub_func` for more details.
         """
 
-        similarities = tf.ones(len(interpret_samples), dtype=tf.float32)
+        similarities = tf.ones(tf.shape(interpret_samples)[0], dtype=tf.float32)
 
         return similarities
@@ -2,16 +2,22 @@
 Module related to LIME method
 """
 
+import functools
+import hashlib
+import threading
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import tensorflow as tf
 import numpy as np
-from tensorflow.keras.losses import cosine_similarity #pylint:  disable=E0611
 from sklearn import linear_model
+from sklearn.base import clone
 from skimage.segmentation import quickshift, felzenszwalb
 
 from .base import BlackBoxExplainer, sanitize_input_output
-from ..types import Callable, Union, Optional, Any
+from ..commons import get_default_pertub_function, has_ridge_closed_form, solve_ridge, \
+    get_auto_batch_size, euclidean_similarities, cosine_similarities
+from ..types import Callable, Union, Optional, Any, List
 
 class Lime(BlackBoxExplainer):
     """
@@ -48,9 +54,14 @@ class Lime(BlackBoxExplainer):
     batch_size
         Number of perturbed samples to process at once, mandatory when nb_samples is huge.
         Notice, it is different compare to WhiteBox explainers which batch the inputs.
-        Here inputs are process one by one.
+        Here inputs are grouped so that the perturbed samples of several inputs are processed
+        at once when they fit in batch_size, otherwise the perturbed samples of an input are
+        built and processed batch_size at a time.
+        If None, it is set depending on the inputs size so that the perturbed samples
+        processed at once fit in a memory budget of about 1GB, with at most
+        max(nb_samples, 1024) perturbed samples at once.
     interpretable_model
-        Model object to train interpretable model.
+        Model object to train interpretable model, it is cloned for each input.
         See the documentation for more information.
     similarity_kernel
         Function which considering an input, perturbed instances of these input and
@@ -75,12 +86,25 @@ class Lime(BlackBoxExplainer):
         feature (e.g super-pixel).
         It allows to transpose from (resp. to) the original input space to (resp. from)
         the interpretable space.
+        It is called concurrently from tf.data threads (through tf.py_function) and must thus
+        be thread-safe, its exceptions are raised as TensorFlow errors. The mappings are cached
+        by input content, every distinct mapping is kept in memory during the explain call.
         See the documentation for more information.
     nb_samples
         The number of perturbed samples you want to generate for each input sample.
         Default to 150.
     prob
         The probability argument for the default pertub function.
+    sampling_strategy
+        The sampling used by the default pertub function, either "lhs" (Latin Hypercube
+        Sampling, each feature is kept in the same proportion of the perturbed samples,
+        which are stratified) or "uniform" (i.i.d Bernoulli sampling).
+        Default value set to "lhs".
+    predict_dtype
+        Dtype in which the perturbed samples are fed to the model (e.g tf.bfloat16 for models
+        supporting mixed precision), halving the memory traffic of the predictions.
+        If the model rejects it, the predictions are computed in float32.
+        Default to None (i.e the perturbed samples are kept in float32).
     distance_mode
         The distance mode used in the default similarity kernel, you can choose either
         "euclidean" or "cosine" (will compute cosine similarity).
@@ -90,6 +114,12 @@ class Lime(BlackBoxExplainer):
         otherwise you will get all similarity close to 0 leading to poor performance or NaN
         values.
         Default to 45 (i.e adapted for RGB images).
+    auto_kernel_width
+        If True, the kernel width of the default euclidean similarity kernel is set depending
+        on the inputs size, to 0.75 * sqrt(nb_input_features) (i.e the heuristic of the
+        original LIME implementation), instead of kernel_width. It is ignored (with a warning)
+        for the cosine distance or a custom similarity kernel.
+        Default to False.
     """
     def __init__(
         self,
@@ -103,7 +133,10 @@ class Lime(BlackBoxExplainer):
         nb_samples: int = 150,
         distance_mode: str = "euclidean",
         kernel_width: float = 45.0,
-        prob: float = 0.5
+        prob: float = 0.5,
+        sampling_strategy: str = "lhs",
+        predict_dtype: Optional[tf.DType] = None,
+        auto_kernel_width: bool = False
         ): # pylint: disable=R0913
 
         if not all(hasattr(interpretable_model, attr) for attr in ['fit', 'predict']):
@@ -113,30 +146,43 @@ class Lime(BlackBoxExplainer):
                 "explanation) once fit is called."
                 )
 
-        if similarity_kernel is None:
-            similarity_kernel = Lime._get_exp_kernel_func(distance_mode, kernel_width)
+        if auto_kernel_width and (similarity_kernel is not None or distance_mode != "euclidean"):
+            warnings.warn(
+                "auto_kernel_width is only supported by the default euclidean similarity kernel, "
+                "it is ignored."
+            )
+            auto_kernel_width = False
+
+        # the default kernels and pertub functions are cached, python floats are hashable
+        if similarity_kernel is None and not auto_kernel_width:
+            similarity_kernel = Lime._get_exp_kernel_func(distance_mode, float(kernel_width))
 
         if pertub_func is None:
-            pertub_func = Lime._get_default_pertub_function(prob)
+            # the default pertub function handles several inputs at once
+            pertub_func = get_default_pertub_function(float(prob), sampling_strategy)
+        else:
+            pertub_func = Lime._get_batched_pertub_function(pertub_func)
 
         if (nb_samples>=500) and (batch_size is None):
             warnings.warn(
                 "You set a number of perturbed samples per input >= 500 and "
-                "batch_size is set to None"
-                "This mean that you will ask your model to handle more than 500"
-                " perturbed samples per input at once."
-                "This can lead to OOM issue. To avoid it you can set the"
-                " batch_size argument."
+                "batch_size is set to None. "
+                "This mean that your model may have to handle more than 500 "
+                "perturbed samples at once. "
+                "This can lead to OOM issue. To avoid it you can set the "
+                "batch_size argument."
             )
 
         super().__init__(model, batch_size)
 
         self.map_to_interpret_space = map_to_interpret_space
         self.interpretable_model = interpretable_model
+        # with auto_kernel_width, the kernel is set at explain time (see `_get_similarity_kernel`)
         self.similarity_kernel = similarity_kernel
         self.pertub_func = pertub_func
         self.ref_value = ref_value
         self.nb_samples = nb_samples
+        self.predict_dtype = None if predict_dtype is None else tf.as_dtype(predict_dtype)
 
     @sanitize_input_output
     def explain(self,
@@ -174,35 +220,16 @@ class Lime(BlackBoxExplainer):
         is_tabular = len(inputs.shape) == 2
         has_channels = len(inputs.shape )== 4
 
-        if has_channels:
-            # default quickshift segmentation for image
-            if self.map_to_interpret_space is None:
+        if self.map_to_interpret_space is None:
+            if has_channels:
+                # default quickshift segmentation for image
                 self.map_to_interpret_space = Lime._default_image_map_to_interpret_space
-            # if inputs have channels ensure
-            if self.ref_value is None:
-                if inputs.shape[-1] == 3:
-                    # grey pixel
-                    ref_value = tf.ones(inputs.shape[-1])*0.5
-                else:
-                    ref_value = tf.zeros(inputs.shape[-1])
+            elif is_tabular:
+                self.map_to_interpret_space = Lime._default_tab_map_to_interpret_space
             else:
-                assert(
-                    self.ref_value.shape[0] == inputs.shape[-1]
-                ),"The dimension of ref_values must match inputs (C, )"
-                ref_value = tf.cast(self.ref_value, tf.float32)
-        else:
-            if self.map_to_interpret_space is None:
-                if is_tabular:
-                    self.map_to_interpret_space = Lime._default_tab_map_to_interpret_space
-                else:
-                    self.map_to_interpret_space = Lime._default_2dimage_map_to_interpret_space
+                self.map_to_interpret_space = Lime._default_2dimage_map_to_interpret_space
 
-            if self.ref_value is None:
-                ref_value = tf.zeros(1)
-            else:
-                ref_value = tf.cast(self.ref_value, tf.float32)
-
-        batch_size = self.batch_size or self.nb_samples
+        batch_size = self.batch_size or get_auto_batch_size(inputs.shape[1:], self.nb_samples)
 
         return Lime._compute(self.model,
                             batch_size,
@@ -210,13 +237,67 @@ class Lime(BlackBoxExplainer):
                             targets,
                             self.inference_function,
                             self.interpretable_model,
-                            self.similarity_kernel,
+                            self._get_similarity_kernel(inputs),
                             self.pertub_func,
-                            ref_value,
+                            self._get_ref_value(inputs),
                             self.map_to_interpret_space,
                             self.nb_samples,
+                            self.predict_dtype,
                             )
 
+    def _get_ref_value(self, inputs: tf.Tensor) -> tf.Tensor:
+        """
+        This method gets the reference value which replaces each feature when the corresponding
+        interpretable feature is set to 0, depending on the inputs channels.
+
+        Parameters
+        ----------
+        inputs
+            The inputs we want to explain
+
+        Returns
+        -------
+        ref_value
+            The reference value, with shape (C,) if the inputs have channels and (1,) otherwise
+        """
+        # if inputs have channels ensure the reference value matches them
+        if len(inputs.shape) == 4:
+            if self.ref_value is None:
+                if inputs.shape[-1] == 3:
+                    # grey pixel
+                    return tf.ones(inputs.shape[-1])*0.5
+                return tf.zeros(inputs.shape[-1])
+
+            assert(
+                self.ref_value.shape[0] == inputs.shape[-1]
+            ),"The dimension of ref_values must match inputs (C, )"
+
+        if self.ref_value is None:
+            return tf.zeros(1)
+
+        return tf.cast(self.ref_value, tf.float32)
+
+    def _get_similarity_kernel(self, inputs: tf.Tensor) -> Callable:
+        """
+        This method gets the similarity kernel of the explainer. With auto_kernel_width, it is
+        the default euclidean kernel with a width of 0.75 * sqrt(nb_input_features).
+
+        Parameters
+        ----------
+        inputs
+            The inputs we want to explain
+
+        Returns
+        -------
+        similarity_kernel
+            Function which compute the similarities between an input and its perturbed samples
+        """
+        if self.similarity_kernel is not None:
+            return self.similarity_kernel
+
+        kernel_width = 0.75 * np.sqrt(np.prod(inputs.shape[1:]))
+        return Lime._get_exp_kernel_func("euclidean", float(kernel_width))
+
     @staticmethod
     def _compute(model: Callable,
                 batch_size: int,
@@ -229,6 +310,7 @@ class Lime(BlackBoxExplainer):
                 ref_value: tf.Tensor,
                 map_to_interpret_space: Callable[[tf.Tensor], tf.Tensor],
                 nb_samples: int,
+                predict_dtype: Optional[tf.DType] = None,
                 ) -> tf.Tensor:
                 # pylint: disable=R0913
         """
@@ -241,6 +323,8 @@ class Lime(BlackBoxExplainer):
         ----------
         model
             The model from which we want to obtain explanations
+        batch_size
+            Number of perturbed samples to process at once.
         inputs
             Dataset, Tensor or Array. Input samples to be explained.
             If Dataset, targets should not be provided (included in Dataset).
@@ -258,7 +342,8 @@ class Lime(BlackBoxExplainer):
             Function which considering an input, perturbed instances of thoses samples and the
             interpretable version of those perturbed samples compute the similarities.
         pertub_function
-            Function which generate perturbed interpretable samples in the interpretation space.
+            Function which generate perturbed interpretable samples in the interpretation space,
+            for several inputs at once (see `_get_batched_pertub_function`).
         ref_values
             It defines reference value which replaces each feature when the corresponding
             interpretable feature is set to 0.
@@ -267,6 +352,8 @@ class Lime(BlackBoxExplainer):
             feature (e.g super-pixel).
         nb_samples
             The number of perturbed samples you want to generate for each input sample.
+        predict_dtype
+            Dtype in which the perturbed samples are fed to the model, float32 if None.
 
         Returns
         -------
@@ -276,120 +363,353 @@ class Lime(BlackBoxExplainer):
             interpretable space will be given the same value to coefficient which were grouped
             together (e.g belonging to the same super-pixel).
         """
+        groups_coefs = []
+
+        # group the inputs so that each group yields about batch_size perturbed samples,
+        # this way a single model call can handle the perturbed samples of several inputs,
+        # when nb_samples is larger than batch_size, the samples of an input are sliced instead
+        inputs_batch_size = max(1, batch_size // nb_samples)
+        samples_batch_size = min(batch_size, nb_samples)
+
+        # the default kernels compute the similarities of a whole group in a single call
+        batched_similarity_kernel = Lime._get_batched_similarity_kernel(similarity_kernel)
+
+        # scikit-learn interpretable models are fitted in background threads, while the
+        # perturbed samples of the next inputs are built and predicted
+        with ThreadPoolExecutor() as fit_executor:
+            # the mappings of the next inputs are computed while the current ones are processed
+            for b_inp, b_targets, mappings in Lime._get_mappings_dataset(map_to_interpret_space,
+                                                                         inputs, targets,
+                                                                         inputs_batch_size):
+                # get the number of interpretable feature of each input
+                num_features = tf.reduce_max(tf.reshape(mappings, (len(b_inp), -1)), axis=1) + 1
+                if tf.reduce_any(tf.greater(num_features, 10000)):
+                    warnings.warn(
+                        "The current input got a number of interpretable features > 10000. "
+                        "This can be very slow or lead to OOM issues when fitting the "
+                        "interpretable model. You should consider using a map function which "
+                        "select less features."
+                    )
+
+                # get perturbed interpretable samples of the inputs, padded to the largest
+                # interpretable space of the group: (nb_inputs, nb_samples, max_num_features)
+                # it is rounded up to a power of 2 to limit the number of XLA compilations
+                max_num_features = 1 << (int(tf.reduce_max(num_features)) - 1).bit_length()
+                interpret_samples = tf.cast(pertub_func(num_features, nb_samples), tf.bool)
+                interpret_samples = tf.pad(interpret_samples, [
+                    [0, 0], [0, 0], [0, max_num_features - interpret_samples.shape[-1]]
+                ])
+
+                # the similarity kernel and the interpretable model get the interpretable samples
+                # of each input without padding, as integers
+                inputs_interpret_samples = [
+                    tf.cast(interpret_samples[inp_idx, :, :inp_num_features], tf.int32)
+                    for inp_idx, inp_num_features in enumerate(num_features)
+                ]
+
+                # the interpretable samples are processed by slices, so that at most batch_size
+                # perturbed samples are built at once (whole inputs if they fit in batch_size)
+                perturbed_targets = []
+                similarities = []
+                for start in range(0, nb_samples, samples_batch_size):
+                    end = start + samples_batch_size
+
+                    # get the perturbed samples of all the inputs at once and flatten them so
+                    # that the model is called on (nb_inputs * nb_slice_samples, ...) samples
+                    perturbed_samples = Lime._get_perturbed_samples(
+                        interpret_samples[:, start:end], mappings, b_inp, ref_value)
+                    flatten_perturbed_samples = tf.reshape(perturbed_samples,
+                                                           (-1, *perturbed_samples.shape[2:]))
+
+                    batch_perturbed_targets = Lime._batch_predictions(inference_function,
+                                                                      model,
+                                                                      flatten_perturbed_samples,
+                                                                      b_targets,
+                                                                      perturbed_samples.shape[1],
+                                                                      batch_size,
+                                                                      predict_dtype)
+                    perturbed_targets.append(tf.reshape(batch_perturbed_targets,
+                                                        (len(b_inp), -1)))
+
+                    # get the similarities between each input and its perturbed samples
+                    similarities.append(batched_similarity_kernel(
+                        b_inp,
+                        [int_samples[start:end] for int_samples in inputs_interpret_samples],
+                        perturbed_samples))
+
+                perturbed_targets = tf.concat(perturbed_targets, axis=1)
+                similarities = tf.concat(similarities, axis=1)
+
+                # similarities all close to 0 (e.g kernel width too small for the inputs size)
+                # would give a degenerate interpretable model, the samples are not weighted then
+                degenerate_inputs = tf.reduce_max(similarities, axis=1) < 1e-12
+                if tf.reduce_any(degenerate_inputs):
+                    warnings.warn(
+                        "The similarities of some inputs with their perturbed samples are all "
+                        "close to 0, their perturbed samples are not weighted. You should "
+                        "consider using a larger kernel width or auto_kernel_width."
+                    )
+                    similarities = tf.where(degenerate_inputs[:, None],
+                                            tf.ones_like(similarities), similarities)
+
+                # train the interpretable models
+                if has_ridge_closed_form(interpretable_model):
+                    # the default ridge is solved for all the inputs at once, padded interpretable
+                    # features are null and thus get a null coefficient
+                    # alpha is given as a tensor so the solver is not retraced for each value
+                    alpha = tf.constant(np.asarray(interpretable_model.alpha).item(), tf.float32)
+                    coefs = solve_ridge(interpret_samples,
+                                        perturbed_targets,
+                                        similarities,
+                                        alpha,
+                                        interpretable_model.fit_intercept)
+                else:
+                    # each input gets its own copy of the interpretable model, the padded
+                    # coefficients are collected once all the inputs are processed
+                    coefs = [
+                        fit_executor.submit(Lime._fit_interpretable_model,
+                                            interpretable_model,
+                                            int_samples,
+                                            inp_perturbed_targets,
+                                            inp_similarities,
+                                            max_num_features)
+                        for int_samples, inp_perturbed_targets, inp_similarities in zip(
+                            inputs_interpret_samples, perturbed_targets, similarities)
+                    ]
+
+                groups_coefs.append((coefs, mappings))
+
         explanations = []
+        for coefs, mappings in groups_coefs:
+            if not isinstance(coefs, tf.Tensor):
+                coefs = tf.stack([future.result() for future in coefs], axis=0)
 
-        for inp, target in tf.data.Dataset.from_tensor_slices(
-            (inputs, targets)
-        ):
-            # get the mapping of the current input
-            mapping = map_to_interpret_space(inp)
-            # get the number of interpretable feature
-            num_features = tf.reduce_max(mapping) + tf.ones(1, dtype=tf.int32)
-            if tf.greater(num_features, 10000):
-                warnings.warn(
-                    "The current input got a number of interpretable features > 10000. "
-                    "This can be very slow or lead to OOM issues when fitting the interpretable "
-                    "model. You should consider using a map function which select less features."
-                )
+            # broadcast explanations to match the original inputs shapes
+            # except for channels
+            explanations.append(Lime._broadcast_explanation(coefs, mappings))
 
-            # get perturbed interpretable samples of the input
-            interpret_samples = pertub_func(num_features, nb_samples)
+        explanations = tf.concat(explanations, axis=0)
 
-            # get the perturbed targets value and the similarities value
-            perturbed_targets = []
-            similarities = []
-            for int_samples in tf.data.Dataset.from_tensor_slices(
-                interpret_samples
-            ).batch(batch_size):
+        return explanations
 
-                masks = Lime._get_masks(int_samples, mapping)
-                perturbed_samples = Lime._apply_masks(inp, masks, ref_value)
+    @staticmethod
+    def _fit_interpretable_model(interpretable_model: Any,
+                                 interpret_samples: tf.Tensor,
+                                 perturbed_targets: tf.Tensor,
+                                 similarities: tf.Tensor,
+                                 max_num_features: int) -> tf.Tensor:
+        """
+        This method fits a copy of the interpretable model on the interpretable samples of
+        a single input, it is meant to be run in a background thread.
 
-                augmented_target = tf.expand_dims(target, axis=0)
-                augmented_target = tf.repeat(augmented_target, len(perturbed_samples), axis=0)
+        Parameters
+        ----------
+        interpretable_model
+            Model object to train interpretable model, it is cloned before being fitted.
+        interpret_samples
+            Tensor of shape (nb_samples, num_features)
+            Intrepretable samples of the input.
+        perturbed_targets
+            Predictions of the model on the perturbed samples of the input.
+        similarities
+            Similarities between the input and its perturbed samples, used as sample weights.
+        max_num_features
+            Size of the padded interpretable space of the group of inputs.
 
-                batch_perturbed_targets = inference_function(model,
-                                                            perturbed_samples,
-                                                            augmented_target)
+        Returns
+        -------
+        coef
+            The coefficients of the interpretable model, padded to max_num_features.
+        """
+        explain_model = clone(interpretable_model, safe=False)
 
-                perturbed_targets.append(batch_perturbed_targets)
+        explain_model.fit(
+            interpret_samples.numpy(),
+            perturbed_targets.numpy(),
+            sample_weight=similarities.numpy()
+        )
 
-                batch_similarities = similarity_kernel(inp, int_samples, perturbed_samples)
-                similarities.append(batch_similarities)
+        # cast the interpretable explanation
+        coef = tf.cast(explain_model.coef_, dtype=tf.float32)
+        coef = tf.pad(coef, [[0, max_num_features - len(coef)]])
 
-            perturbed_targets = tf.concat(perturbed_targets, axis=0)
-            similarities = tf.concat(similarities, axis=0)
+        return coef
 
-            # train the interpretable model
-            explain_model = interpretable_model
+    @staticmethod
+    def _batch_predictions(inference_function: Callable,
+                           model: Callable,
+                           perturbed_samples: tf.Tensor,
+                           targets: tf.Tensor,
+                           nb_samples: int,
+                           batch_size: int,
+                           predict_dtype: Optional[tf.DType] = None) -> tf.Tensor:
+        """
+        This method computes the predictions of the model on the perturbed samples by batch,
+        the batches are sliced from the perturbed samples so that they are not copied.
+        The targets are not repeated for each perturbed sample, those of a batch are gathered
+        from the index of the input of each sample.
+        If the model rejects the perturbed samples casted to predict_dtype, the predictions
+        are computed in float32. The targets are casted to the output dtype of Keras models.
+
+        Parameters
+        ----------
+        inference_function
+            Function that allows to get the probability output of the model
+        model
+            The model from which we want to obtain explanations
+        perturbed_samples
+            The perturbed samples of all the inputs, with shape (nb_perturbed_samples, ...)
+        targets
+            The target of each input, with shape (nb_inputs, output_size)
+        nb_samples
+            The number of perturbed samples of each input.
+        batch_size
+            Number of perturbed samples to process at once.
+        predict_dtype
+            Dtype of the perturbed samples fed to the model, if None they are kept in float32.
 
-            explain_model.fit(
-                interpret_samples.numpy(),
-                perturbed_targets.numpy(),
-                sample_weight=similarities.numpy()
+        Returns
+        -------
+        perturbed_targets
+            Predictions scores of the model, only for the target class, in float32.
+        """
+        # index of the input of each perturbed sample
+        inputs_indices = tf.range(len(perturbed_samples)) // nb_samples
+
+        # the targets are casted to the output dtype of the model when it is known, so that
+        # they can be multiplied with the outputs of a mixed precision model
+        model_outputs = getattr(model, "outputs", None)
+        if model_outputs:
+            targets = tf.cast(targets, model_outputs[0].dtype)
+
+        def predict(samples):
+            return tf.concat([
+                tf.cast(inference_function(model,
+                                           samples[start:start + batch_size],
+                                           tf.gather(targets,
+                                                     inputs_indices[start:start + batch_size])),
+                        tf.float32)
+                for start in range(0, len(samples), batch_size)
+            ], axis=0)
+
+        if predict_dtype is None:
+            return predict(perturbed_samples)
+
+        try:
+            perturbed_targets = predict(tf.cast(perturbed_samples, predict_dtype))
+        # only the dtype rejections are caught, an OOM must not be retried in float32
+        except (TypeError, tf.errors.InvalidArgumentError, tf.errors.UnimplementedError):
+            warnings.warn(
+                f"The model does not support inputs of dtype {predict_dtype.name}, "
+                "its predictions are computed in float32 instead."
             )
+            perturbed_targets = predict(perturbed_samples)
 
-            explanation = explain_model.coef_
-            # cast the interpretable explanation
-            explanation = tf.cast(explanation, dtype=tf.float32)
+        return perturbed_targets
 
-            # broadcast explanations to match the original inputs shapes
-            # except for channels
-            explanation = Lime._broadcast_explanation(explanation, mapping)
+    @staticmethod
+    def _get_mappings_dataset(map_to_interpret_space: Callable[[tf.Tensor], tf.Tensor],
+                              inputs: tf.Tensor,
+                              targets: tf.Tensor,
+                              inputs_batch_size: int) -> tf.data.Dataset:
+        """
+        This method builds a dataset of the groups of inputs along with their mappings.
+        As segmentation algorithms (e.g quickshift) run on CPU one input at a time, the map
+        function is called on several inputs in parallel and the next group is prefetched.
+        The mappings are computed once per distinct input, so that an input explained for
+        several targets is only segmented once.
 
-            explanations.append(explanation)
+        Parameters
+        ----------
+        map_to_interpret_space
+            Function which group features of an input corresponding to the same interpretable
+            feature (e.g super-pixel).
+        inputs
+            The inputs we want to explain
+        targets
+            One-hot encoding of the model's output from which an explanation is desired.
+        inputs_batch_size
+            Number of inputs per group.
 
-        explanations = tf.stack(explanations, axis=0)
+        Returns
+        -------
+        dataset
+            Dataset of (inputs, targets, mappings) groups, the mappings being int32 tensors
+            with shape (nb_inputs, ...)
+        """
+        cached_mappings = {}
+        inputs_locks = {}
+        cache_lock = threading.Lock()
 
-        return explanations
+        def get_mapping(inp):
+            inp_key = hashlib.sha1(inp.numpy().tobytes()).digest()
+            # the same input is not mapped concurrently by several threads
+            with cache_lock:
+                inp_lock = inputs_locks.setdefault(inp_key, threading.Lock())
+            with inp_lock:
+                if inp_key not in cached_mappings:
+                    cached_mappings[inp_key] = tf.cast(map_to_interpret_space(inp), tf.int32)
+            return cached_mappings[inp_key]
+
+        def map_with_mapping(inp, target):
+            mapping = tf.py_function(get_mapping, [inp], tf.int32)
+            return inp, target, mapping
+
+        dataset = tf.data.Dataset.from_tensor_slices((inputs, targets))
+        dataset = dataset.map(map_with_mapping, num_parallel_calls=tf.data.AUTOTUNE)
+
+        return dataset.batch(inputs_batch_size).prefetch(tf.data.AUTOTUNE)
 
     @staticmethod
     @tf.function(
         input_signature=(
-            tf.TensorSpec(shape=[None, None], dtype=tf.int32),
+            tf.TensorSpec(shape=[None, None, None], dtype=tf.bool),
             tf.TensorSpec(shape=None, dtype=tf.int32)
         )
     )
-    def _get_masks(interpret_samples: tf.Tensor, mapping: tf.Tensor) -> tf.Tensor:
+    def _get_masks(interpret_samples: tf.Tensor, mappings: tf.Tensor) -> tf.Tensor:
         """
-        This method translate the generated samples in the interpretable space of an input into
-        masks to apply to the original input to obtain samples in the original input space.
+        This method translate the generated samples in the interpretable space of the inputs into
+        masks to apply to the original inputs to obtain samples in the original input space.
 
         Parameters
         ----------
         interpret_samples
-            Tensor of shape (nb_samples, num_features)
-            Intrepretable samples of an input, with:
+            Boolean tensor of shape (nb_inputs, nb_samples, num_features)
+            Intrepretable samples of each input, with:
+                nb_inputs number of inputs
                 nb_samples number of samples
                 num_features the dimension of the interpretable space.
-        mapping
+        mappings
             Tensor
-            The mapping of the original input from which we drawn interpretable samples.
-            Its size is equal to width (and height) of the original input
+            The mappings of the original inputs from which we drawn interpretable samples.
+            Its size is equal to width (and height) of the original inputs
 
         Returns
         -------
         masks
-            The masks corresponding to each interpretable samples
+            The boolean masks corresponding to each interpretable samples, with shape
+            (nb_inputs, nb_samples, *mapping.shape)
         """
-        tf_masks = tf.gather(interpret_samples, indices=mapping, axis=1)
+        tf_masks = tf.gather(interpret_samples, indices=mappings, axis=2, batch_dims=1)
         return tf_masks
 
     @staticmethod
     @tf.function
-    def _apply_masks(original_input: tf.Tensor,
+    def _apply_masks(original_inputs: tf.Tensor,
                      sample_masks: tf.Tensor,
                      ref_value: tf.Tensor) -> tf.Tensor:
         """
         This method apply masks obtained from the perturbed interpretable samples to the
-        original input (i.e we get perturbed samples in the original space).
+        original inputs (i.e we get perturbed samples in the original space).
 
         Parameters
         ----------
-        original_input
-            The input we want to explain
+        original_inputs
+            The inputs we want to explain
         sample_masks
-            The masks we obtained from the perturbed instances in the interpretable space
+            The masks we obtained from the perturbed instances in the interpretable space,
+            with shape (nb_inputs, nb_samples, ...)
         ref_value
             The reference value which replaces each feature when the corresponding
             interpretable feature is set to 0
@@ -397,102 +717,146 @@ class Lime(BlackBoxExplainer):
         Returns
         -------
         perturbed_samples
-            The perturbed samples corresponding to the masks applied to the original input
+            The perturbed samples corresponding to the masks applied to the original inputs,
+            with shape (nb_inputs, nb_samples, ...)
         """
-        pert_samples = tf.expand_dims(original_input, axis=0)
-        pert_samples = tf.repeat(pert_samples, repeats=sample_masks.shape[0], axis=0)
+        masks = tf.cast(sample_masks, tf.float32)
 
         # if there is channels we need to expand masks dimension
-        if len(original_input.shape)==3:
-
-            sample_masks = tf.expand_dims(sample_masks, axis=-1)
-            sample_masks = tf.repeat(sample_masks, repeats=original_input.shape[-1], axis=-1)
+        if len(original_inputs.shape)==4:
+            masks = tf.expand_dims(masks, axis=-1)
 
-            pert_samples = pert_samples * tf.cast(sample_masks, tf.float32)
-            ref_val = tf.reshape(ref_value, (1,1,1,original_input.shape[-1]))
+        # the inputs are broadcasted along the samples axis, the masks along the channels axis
+        # and the reference value along all the axis but the channels one
+        pert_samples = tf.expand_dims(original_inputs, axis=1) * masks + ref_value * (1.0 - masks)
 
-        else:
+        return pert_samples
 
-            pert_samples = pert_samples * tf.cast(sample_masks, tf.float32)
-            ref_val = tf.reshape(ref_value, (1, *(1,) * len(original_input.shape)))
+    @staticmethod
+    @tf.function(jit_compile=True)
+    def _get_perturbed_samples(interpret_samples: tf.Tensor,
+                               mappings: tf.Tensor,
+                               original_inputs: tf.Tensor,
+                               ref_value: tf.Tensor) -> tf.Tensor:
+        """
+        This method gets the perturbed samples of the inputs from their interpretable samples.
+        It is compiled with XLA so the masks gathering and their application are fused,
+        the masks are not materialized in memory.
 
-        pert_samples += (tf.ones((sample_masks.shape)) - tf.cast(sample_masks, tf.float32))*ref_val
+        Parameters
+        ----------
+        interpret_samples
+            Boolean tensor of shape (nb_inputs, nb_samples, num_features)
+            Intrepretable samples of each input.
+        mappings
+            The mappings of the original inputs from which we drawn interpretable samples.
+        original_inputs
+            The inputs we want to explain
+        ref_value
+            The reference value which replaces each feature when the corresponding
+            interpretable feature is set to 0
 
-        return pert_samples
+        Returns
+        -------
+        perturbed_samples
+            The perturbed samples of each input, with shape (nb_inputs, nb_samples, ...)
+        """
+        masks = Lime._get_masks(interpret_samples, mappings)
+        return Lime._apply_masks(original_inputs, masks, ref_value)
 
     @staticmethod
     @tf.function(
         input_signature=(
-            tf.TensorSpec(shape=None, dtype=tf.float32),
+            tf.TensorSpec(shape=[None, None], dtype=tf.float32),
             tf.TensorSpec(shape=None, dtype=tf.int32)
         )
     )
-    def _broadcast_explanation(explanation: tf.Tensor, mapping: tf.Tensor) -> tf.Tensor:
+    def _broadcast_explanation(explanations: tf.Tensor, mappings: tf.Tensor) -> tf.Tensor:
         """
         This method allows to broadcast explanations from the interpretable space to the
-        corresponding super pixels
+        corresponding super pixels, for several inputs at once
 
         Parameters
         ----------
-        explanation
-            Explanation value for each super pixel
-        mapping
-            The mapping of the original input from which we drawn interpretable samples
+        explanations
+            Explanation value for each super pixel of each input,
+            with shape (nb_inputs, num_features)
+        mappings
+            The mappings of the original inputs from which we drawn interpretable samples
             (i.e features index).
 
         Returns
         -------
-        broadcast_explanation
-            The explanation of the current input considered
+        broadcast_explanations
+            The explanations of the inputs considered, with shape (nb_inputs, *mapping.shape)
         """
 
-        broadcast_explanation = tf.gather(explanation, indices=mapping, axis=0)
-        return broadcast_explanation
+        broadcast_explanations = tf.gather(explanations, indices=mappings, axis=1, batch_dims=1)
+        return broadcast_explanations
 
     @staticmethod
-    def _get_default_pertub_function(
-        prob: float = 0.5
-        ) -> Callable[[Union[int, tf.Tensor],int], tf.Tensor]:
+    def _get_batched_pertub_function(
+        pertub_func: Callable[[Union[int, tf.Tensor],int], tf.Tensor]
+        ) -> Callable[[tf.Tensor,int], tf.Tensor]:
         """
-        This method allows you to get a pertub function with the corresponding prob
-        argument.
+        This method wraps a pertub function generating the interpretable samples of a single
+        input into a function generating those of several inputs, given the vector of their
+        number of features. The samples are padded to the largest interpretable space.
+        As before the inputs were grouped, the pertub function gets the number of features of
+        an input as a tensor of shape (1,).
         """
 
-        prob = tf.cast(prob, dtype=tf.float32)
-        @tf.function
-        def _default_pertub_function(num_features: Union[int, tf.Tensor],
+        def _batched_pertub_function(num_features: tf.Tensor,
                                      nb_samples: int) -> tf.Tensor:
-            """
-            This method generate nb_samples tensor belonging to {0,1}^num_features.
-            The prob argument is the probability to have a 1.
-
-            Parameters
-            ----------
-            num_features
-                The number of interpretable features (e.g super pixel).
-            nb_samples
-                The number of perturbed interpretable samples we want
-            prob:
-                It defines the probability to draw a 1
-
-            Returns
-            -------
-            interpretable_perturbed_samples
-                Tensor of shape (nb_samples, num_features)
-            """
-
-            probs = tf.ones(num_features, tf.float32) * tf.cast(prob, tf.float32)
-            uniform_sampling = tf.random.uniform(shape=[nb_samples, tf.squeeze(num_features)],
-                                                dtype=tf.float32,
-                                                minval=0,
-                                                maxval=1)
-            sample = tf.greater(probs, uniform_sampling)
-            sample = tf.cast(sample, dtype=tf.int32)
-            return sample
-
-        return _default_pertub_function
+            max_num_features = tf.reduce_max(num_features)
+            interpret_samples = tf.stack([
+                tf.pad(tf.cast(pertub_func(tf.reshape(inp_num_features, [1]), nb_samples), tf.bool),
+                       [[0, 0], [0, max_num_features - inp_num_features]])
+                for inp_num_features in num_features
+            ], axis=0)
+            return interpret_samples
+
+        return _batched_pertub_function
+
+    @staticmethod
+    def _get_batched_similarity_kernel(
+        similarity_kernel: Callable[[tf.Tensor, tf.Tensor, tf.Tensor], tf.Tensor]
+        ) -> Callable[[tf.Tensor, List[tf.Tensor], tf.Tensor], tf.Tensor]:
+        """
+        This method wraps a similarity kernel of a single input into a function computing the
+        similarities of several inputs, given the list of their interpretable samples.
+        The default kernels compute the similarities of all the inputs in a single call, the
+        others are called for each input.
+        """
+        if isinstance(similarity_kernel, functools.partial) and similarity_kernel.func in (
+                Lime._euclidean_similarity_kernel, Lime._cosine_similarity_kernel):
+            similarities_func = euclidean_similarities \
+                if similarity_kernel.func is Lime._euclidean_similarity_kernel \
+                else cosine_similarities
+            kernel_width = similarity_kernel.keywords["kernel_width"]
+
+            def _batched_default_kernel(original_inputs: tf.Tensor,
+                                        interpret_samples: List[tf.Tensor],
+                                        perturbed_samples: tf.Tensor) -> tf.Tensor:
+            # pylint: disable=unused-argument
+                return similarities_func(original_inputs, perturbed_samples, kernel_width)
+
+            return _batched_default_kernel
+
+        def _batched_similarity_kernel(original_inputs: tf.Tensor,
+                                       interpret_samples: List[tf.Tensor],
+                                       perturbed_samples: tf.Tensor) -> tf.Tensor:
+            return tf.stack([
+                tf.cast(similarity_kernel(inp, int_samples, inp_pert_samples), tf.float32)
+                for inp, int_samples, inp_pert_samples in zip(original_inputs,
+                                                              interpret_samples,
+                                                              perturbed_samples)
+            ], axis=0)
+
+        return _batched_similarity_kernel
 
     @staticmethod
+    @functools.lru_cache(maxsize=16)
     def _get_exp_kernel_func(
         distance_mode: str = "euclidean", kernel_width: float = 1.0
     ) -> Callable[[tf.Tensor, tf.Tensor, tf.Tensor], tf.Tensor]:
@@ -500,6 +864,8 @@ class Lime(BlackBoxExplainer):
         This method allow to get the function which compute:
             exp(-D(original_input,perturbed_sample)^2/kernel_width^2)
         Where D is the distance defined by distance mode.
+        The kernels are shared (and thus traced once) by all the explainers, the functions
+        returned are cached for each distance mode and kernel width.
 
         Parameters
         ----------
@@ -514,66 +880,45 @@ class Lime(BlackBoxExplainer):
             This callable should return distances between inputs and its perturbed samples
             (either in original space or in the interpretable space).
         """
-        kernel_width = tf.cast(kernel_width,dtype=tf.float32)
-
         if distance_mode=="euclidean":
-            @tf.function(
-                input_signature = (
-                    tf.TensorSpec(shape=None, dtype=tf.float32),
-                    tf.TensorSpec(shape=[None, None], dtype=tf.int32),
-                    tf.TensorSpec(shape=None, dtype=tf.float32)
-                )
-            )
-            def _euclidean_similarity_kernel(
-                original_input,
-                interp_samples,
-                perturbed_samples
-            ) -> tf.Tensor:
-            # pylint: disable=unused-argument
-
-                augmented_input = tf.expand_dims(original_input, axis=0)
-                augmented_input = tf.repeat(augmented_input, repeats=len(interp_samples), axis=0)
-
-                flatten_inputs = tf.reshape(augmented_input, [len(interp_samples),-1])
-                flatten_samples = tf.reshape(perturbed_samples, [len(interp_samples),-1])
-
-                distances = tf.norm(flatten_inputs - flatten_samples, ord='euclidean', axis=1)
-
-                similarities = tf.exp(-1.0 * (distances**2) / (kernel_width**2))
-
-                return similarities
-
-            return _euclidean_similarity_kernel
+            return functools.partial(Lime._euclidean_similarity_kernel,
+                                     kernel_width=float(kernel_width))
 
         if distance_mode=="cosine":
-            @tf.function(
-                input_signature = (
-                    tf.TensorSpec(shape=None, dtype=tf.float32),
-                    tf.TensorSpec(shape=[None, None], dtype=tf.int32),
-                    tf.TensorSpec(shape=None, dtype=tf.float32)
-                )
-            )
-            def _cosine_similarity_kernel(
-                original_input,
-                interp_samples,
-                perturbed_samples
-            ) -> tf.Tensor:
-            # pylint: disable=unused-argument
-
-                augmented_input = tf.expand_dims(original_input, axis=0)
-                augmented_input = tf.repeat(augmented_input, repeats=len(interp_samples), axis=0)
-
-                flatten_inputs = tf.reshape(augmented_input, [len(interp_samples),-1])
-                flatten_samples = tf.reshape(perturbed_samples, [len(interp_samples),-1])
+            return functools.partial(Lime._cosine_similarity_kernel,
+                                     kernel_width=float(kernel_width))
 
-                distances = 1.0 - cosine_similarity(flatten_inputs, flatten_samples, axis=1)
-                similarities = tf.exp(-1.0 * (distances**2) / (kernel_width**2))
-
-                return similarities
+        raise ValueError("distance_mode must be either cosine or euclidean.")
 
-            return _cosine_similarity_kernel
+    @staticmethod
+    def _euclidean_similarity_kernel(
+        original_input: tf.Tensor,
+        interp_samples: tf.Tensor,
+        perturbed_samples: tf.Tensor,
+        kernel_width: float
+    ) -> tf.Tensor:
+    # pylint: disable=unused-argument
+        """
+        This method compute the similarities between an input and its perturbed samples
+        using the euclidean distance in the original input space.
+        """
+        return euclidean_similarities(original_input[None], perturbed_samples[None],
+                                      kernel_width)[0]
 
-        raise ValueError("distance_mode must be either cosine or euclidean.")
+    @staticmethod
+    def _cosine_similarity_kernel(
+        original_input: tf.Tensor,
+        interp_samples: tf.Tensor,
+        perturbed_samples: tf.Tensor,
+        kernel_width: float
+    ) -> tf.Tensor:
+    # pylint: disable=unused-argument
+        """
+        This method compute the similarities between an input and its perturbed samples
+        using the cosine distance in the original input space.
+        """
+        return cosine_similarities(original_input[None], perturbed_samples[None],
+                                   kernel_width)[0]
 
     @staticmethod
     def _default_image_map_to_interpret_space(inp: tf.Tensor) -> tf.Tensor:
@@ -9,3 +9,5 @@ from .tf_operations import repeat_labels, batch_gradient, batch_predictions_one_
     batch_tensor, predictions_one_hot, gradient
 from .callable_operations import predictions_one_hot_callable, \
     batch_predictions_one_hot_callable
+from .lime_operations import get_default_pertub_function, has_ridge_closed_form, solve_ridge, \
+    get_auto_batch_size, euclidean_similarities, cosine_similarities
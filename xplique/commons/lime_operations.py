@@ -0,0 +1,294 @@
+"""
+Sampling and solving operations of the Lime explainer
+"""
+
+import functools
+
+import numpy as np
+import tensorflow as tf
+from sklearn import linear_model
+
+from ..types import Any, Callable, Union, Tuple
+
+
+@functools.lru_cache(maxsize=16)
+def get_default_pertub_function(
+    prob: float = 0.5, sampling_strategy: str = "lhs"
+    ) -> Callable[[Union[int, tf.Tensor],int], tf.Tensor]:
+    """
+    Get the default pertub function of Lime, with the corresponding prob and sampling
+    strategy arguments. The functions returned are cached for each of them, so that they are
+    traced once for all the explainers.
+    """
+
+    if sampling_strategy not in ("lhs", "uniform"):
+        raise ValueError("sampling_strategy must be either lhs or uniform.")
+
+    latin_hypercube = sampling_strategy == "lhs"
+    prob = tf.cast(prob, dtype=tf.float32)
+    @tf.function
+    def _default_pertub_function(num_features: Union[int, tf.Tensor],
+                                 nb_samples: int) -> tf.Tensor:
+        """
+        Generate nb_samples tensor belonging to {0,1}^num_features.
+        The prob argument is the probability to have a 1.
+        With Latin Hypercube Sampling, the samples of each feature are stratified over
+        [0, 1] before being thresholded, so that each feature is kept in the same
+        proportion of the samples.
+        If num_features is a vector, the samples of all the inputs are drawn at once and
+        the features beyond the number of features of an input are set to 0.
+
+        Parameters
+        ----------
+        num_features
+            The number of interpretable features (e.g super pixel), either a scalar
+            or a vector with the number of features of each input.
+        nb_samples
+            The number of perturbed interpretable samples we want
+        prob:
+            It defines the probability to draw a 1
+
+        Returns
+        -------
+        interpretable_perturbed_samples
+            Boolean tensor of shape (nb_samples, num_features), or
+            (nb_inputs, nb_samples, max_num_features) if num_features is a vector
+        """
+
+        num_features = tf.cast(num_features, tf.int32)
+        max_num_features = tf.reduce_max(num_features)
+
+        shape = tf.concat([tf.shape(num_features), [nb_samples, max_num_features]], axis=0)
+        uniform_sampling = tf.random.uniform(shape=shape, dtype=tf.float32,
+                                             minval=0, maxval=1)
+
+        if latin_hypercube:
+            # each feature draws one sample in each of the nb_samples strata of [0, 1],
+            # the strata being shuffled independently for each feature
+            strata = tf.argsort(tf.random.uniform(shape=shape), axis=-2)
+            uniform_sampling = (tf.cast(strata, tf.float32) + uniform_sampling) / \
+                               tf.cast(nb_samples, tf.float32)
+        features_mask = tf.sequence_mask(num_features, max_num_features)[..., None, :]
+
+        sample = tf.logical_and(tf.greater(prob, uniform_sampling), features_mask)
+        return sample
+
+    return _default_pertub_function
+
+
+def has_ridge_closed_form(interpretable_model: Any) -> bool:
+    """
+    Check if the interpretable model is a scikit-learn Ridge which can be trained using its
+    closed form (i.e a strictly positive scalar alpha and no positivity constraint on the
+    coefficients).
+
+    Parameters
+    ----------
+    interpretable_model
+        Model object to train interpretable model.
+
+    Returns
+    -------
+    has_closed_form
+        True if the interpretable model can be trained with `solve_ridge`.
+    """
+    if not isinstance(interpretable_model, linear_model.Ridge):
+        return False
+
+    alpha = np.asarray(interpretable_model.alpha)
+
+    return alpha.size == 1 and float(alpha) > 0.0 and \
+           not getattr(interpretable_model, 'positive', False)
+
+
+@tf.function(jit_compile=True)
+def solve_ridge(interpret_samples: tf.Tensor,
+                perturbed_targets: tf.Tensor,
+                similarities: tf.Tensor,
+                alpha: Union[float, tf.Tensor],
+                fit_intercept: bool = True) -> tf.Tensor:
+    """
+    Solve the weighted ridge regressions of a group of inputs at once, using the same
+    closed form as scikit-learn:
+        coef = (X^T W X + alpha I)^-1 X^T W y
+    or its dual form when there are more interpretable features than perturbed samples.
+    It is compiled with XLA so the weighting, the centering and the products are fused.
+
+    Parameters
+    ----------
+    interpret_samples
+        Tensor of shape (nb_inputs, nb_samples, num_features)
+        Interpretable samples of each input.
+    perturbed_targets
+        Tensor of shape (nb_inputs, nb_samples)
+        Predictions of the model on the perturbed samples of each input.
+    similarities
+        Tensor of shape (nb_inputs, nb_samples)
+        Similarities between each input and its perturbed samples, used as sample weights.
+    alpha
+        Regularization strength of the ridge regression, preferably as a scalar tensor
+        (a python float is traced for each value).
+    fit_intercept
+        Whether to center the samples and targets, as scikit-learn does to fit the intercept.
+
+    Returns
+    -------
+    coefs
+        Tensor of shape (nb_inputs, num_features)
+        Coefficients of the ridge regression of each input.
+    """
+    samples = tf.cast(interpret_samples, tf.float32)
+    targets = tf.expand_dims(tf.cast(perturbed_targets, tf.float32), axis=-1)
+    weights = tf.expand_dims(similarities, axis=-1)
+
+    if fit_intercept:
+        weights_sum = tf.reduce_sum(weights, axis=1, keepdims=True)
+        samples -= tf.reduce_sum(samples * weights, axis=1, keepdims=True) / weights_sum
+        targets -= tf.reduce_sum(targets * weights, axis=1, keepdims=True) / weights_sum
+
+    sqrt_weights = tf.sqrt(weights)
+    samples *= sqrt_weights
+    targets *= sqrt_weights
+
+    alpha = tf.cast(alpha, tf.float32)
+    nb_samples, num_features = samples.shape[1], samples.shape[2]
+
+    if num_features <= nb_samples:
+        gram = tf.matmul(samples, samples, transpose_a=True) + alpha * tf.eye(num_features)
+        coefs = tf.linalg.cholesky_solve(tf.linalg.cholesky(gram),
+                                         tf.matmul(samples, targets, transpose_a=True))
+    else:
+        # solve the dual problem, the kernel is smaller than the gram matrix
+        kernel = tf.matmul(samples, samples, transpose_b=True) + alpha * tf.eye(nb_samples)
+        dual_coefs = tf.linalg.cholesky_solve(tf.linalg.cholesky(kernel), targets)
+        coefs = tf.matmul(samples, dual_coefs, transpose_a=True)
+
+    return tf.squeeze(coefs, axis=-1)
+
+
+
+@tf.function(
+    input_signature = (
+        tf.TensorSpec(shape=None, dtype=tf.float32),
+        tf.TensorSpec(shape=None, dtype=tf.float32),
+        tf.TensorSpec(shape=[], dtype=tf.float32)
+    ),
+    jit_compile=True
+)
+def euclidean_similarities(original_inputs: tf.Tensor,
+                           perturbed_samples: tf.Tensor,
+                           kernel_width: tf.Tensor) -> tf.Tensor:
+    """
+    Compute the similarities of a group of inputs with their perturbed samples, using the
+    euclidean distance in the original input space:
+        exp(-D(original_input,perturbed_sample)^2/kernel_width^2)
+    It is compiled with XLA so the distances and the exponential kernel are fused. The
+    interpretable samples are not part of its signature so that it is not compiled again
+    for each number of interpretable features.
+
+    Parameters
+    ----------
+    original_inputs
+        Tensor of shape (nb_inputs, ...)
+        The inputs to explain.
+    perturbed_samples
+        Tensor of shape (nb_inputs, nb_samples, ...)
+        The perturbed samples of each input.
+    kernel_width
+        The size of the kernel, as a scalar tensor.
+
+    Returns
+    -------
+    similarities
+        Tensor of shape (nb_inputs, nb_samples)
+        Similarities between each input and its perturbed samples.
+    """
+    # the original inputs are broadcasted against all their perturbed samples, the squared
+    # distances are computed directly (no square root to square afterwards)
+    samples_shape = tf.shape(perturbed_samples)
+    flatten_inputs = tf.reshape(original_inputs, [samples_shape[0], 1, -1])
+    flatten_samples = tf.reshape(perturbed_samples, [samples_shape[0], samples_shape[1], -1])
+
+    squared_distances = tf.reduce_sum(
+        tf.math.squared_difference(flatten_samples, flatten_inputs), axis=2)
+
+    inv_squared_width = tf.math.reciprocal(tf.square(kernel_width))
+    return tf.exp(-squared_distances * inv_squared_width)
+
+
+@tf.function(
+    input_signature = (
+        tf.TensorSpec(shape=None, dtype=tf.float32),
+        tf.TensorSpec(shape=None, dtype=tf.float32),
+        tf.TensorSpec(shape=[], dtype=tf.float32)
+    ),
+    jit_compile=True
+)
+def cosine_similarities(original_inputs: tf.Tensor,
+                        perturbed_samples: tf.Tensor,
+                        kernel_width: tf.Tensor) -> tf.Tensor:
+    """
+    Compute the similarities of a group of inputs with their perturbed samples, using the
+    cosine distance in the original input space. As `euclidean_similarities`, it is compiled
+    with XLA independently of the number of interpretable features.
+
+    Parameters
+    ----------
+    original_inputs
+        Tensor of shape (nb_inputs, ...)
+        The inputs to explain.
+    perturbed_samples
+        Tensor of shape (nb_inputs, nb_samples, ...)
+        The perturbed samples of each input.
+    kernel_width
+        The size of the kernel, as a scalar tensor.
+
+    Returns
+    -------
+    similarities
+        Tensor of shape (nb_inputs, nb_samples)
+        Similarities between each input and its perturbed samples.
+    """
+    # cosine similarities of all the perturbed samples with a single batched matmul
+    samples_shape = tf.shape(perturbed_samples)
+    flatten_inputs = tf.math.l2_normalize(
+        tf.reshape(original_inputs, [samples_shape[0], -1, 1]), axis=1)
+    flatten_samples = tf.math.l2_normalize(
+        tf.reshape(perturbed_samples, [samples_shape[0], samples_shape[1], -1]), axis=2)
+
+    distances = 1.0 - tf.squeeze(tf.matmul(flatten_samples, flatten_inputs), axis=2)
+
+    inv_squared_width = tf.math.reciprocal(tf.square(kernel_width))
+    return tf.exp(-tf.square(distances) * inv_squared_width)
+
+def get_auto_batch_size(sample_shape: Tuple[int, ...],
+                        nb_samples: int,
+                        memory_budget: int = 2**30,
+                        safety_factor: int = 8) -> int:
+    """
+    Compute the number of perturbed samples of Lime to process at once when no batch_size
+    is provided, such that the perturbed samples and the model activations fit
+    in a fixed memory budget (TensorFlow does not expose the free memory of a device).
+    As the size of small inputs (e.g tabular data) says nothing about the activations of
+    the model, it is bounded by max(nb_samples, 1024).
+
+    Parameters
+    ----------
+    sample_shape
+        Shape of a single input.
+    nb_samples
+        The number of perturbed samples of each input.
+    memory_budget
+        Memory budget in bytes, default to 1GB.
+    safety_factor
+        Ratio between the memory used by the model on a sample and the sample size.
+
+    Returns
+    -------
+    batch_size
+        Number of perturbed samples to process at once.
+    """
+    sample_bytes = int(np.prod(sample_shape)) * tf.float32.size
+    batch_size = memory_budget // (sample_bytes * safety_factor)
+
+    return max(1, min(batch_size, max(nb_samples, 1024)))